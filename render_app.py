@@ -1,6 +1,9 @@
-import os, json, re
+import os, json, re, time, functools, hmac, socket, hashlib, threading
+from collections import OrderedDict
 from flask import Flask, request, jsonify, Response
-import requests
+from flask.json.provider import JSONProvider
+import httpx
+import orjson
 
 # CORS
 from flask_cors import CORS
@@ -10,7 +13,20 @@ try:
 except ImportError:
     redis = None
 
+# JSON con orjson para get_json/jsonify/respuestas dict (más rápido que json stdlib)
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # === Config desde variables de entorno ===
 CLIENT_API_KEY   = os.getenv("PUBLIC_API_KEY", "")      # clave que enviarán los clientes al proxy (Render)
@@ -18,6 +34,11 @@ UPSTREAM_API_KEY = os.getenv("UPSTREAM_API_KEY", "")    # la que espera TU Flask
 ADMIN_TOKEN      = os.getenv("ADMIN_TOKEN", "")         # token para /admin/register
 REDIS_URL        = os.getenv("REDIS_URL", "")           # opcional (si no hay, se usa memoria)
 DEBUG_HEADERS    = os.getenv("DEBUG_HEADERS", "0") == "1"  # <--- NUEVO: logs opcionales
+ADMIN_TOKEN_B    = ADMIN_TOKEN.encode()
+CLIENT_KEY_ENVIRON = "HTTP_X_CLIENT_KEY"   # x-client-key leído directo del environ WSGI
+TARGET_CACHE_TTL = float(os.getenv("TARGET_CACHE_TTL", "2"))  # segundos que se cachea el destino leído de Redis
+OPTIMUS_CACHE_TTL = float(os.getenv("OPTIMUS_CACHE_TTL", "0"))  # >0 activa la caché de respuestas (segundos)
+OPTIMUS_CACHE_MAX = max(0, int(os.getenv("OPTIMUS_CACHE_MAX", "256")))   # máx. respuestas cacheadas por worker
 
 # === Orígenes permitidos para CORS ===
 origins_env = os.getenv("ALLOWED_ORIGINS", "").strip()
@@ -34,45 +55,164 @@ else:
         "https://wellconnect.optimanage-peru.com",
     ]
 
-# Habilitar CORS solo en rutas de uso público (webhook/health)
+# ✨ SUMA: permitir también x-optimus-model y x-optimus-alias
+CORS_ALLOW_HEADERS = ["Content-Type", "x-client-key", "x-optimus-model", "x-optimus-alias"]
+CORS_MAX_AGE = 86400  # los navegadores cachean el preflight 24 h
+
+# Flask-CORS solo para /health; /webhook/optimus resuelve CORS a mano (ver proxy_optimus)
+# para no pasar por el middleware en cada request del camino caliente
 CORS(
     app,
     resources={
-        r"/webhook/*": {"origins": ALLOWED_ORIGINS},
         r"/health": {"origins": "*"},  # útil para pruebas
     },
     methods=["GET", "POST", "OPTIONS"],
-    # ✨ SUMA: permitir también x-optimus-model y x-optimus-alias
-    allow_headers=["Content-Type", "x-client-key", "x-optimus-model", "x-optimus-alias"],
+    allow_headers=CORS_ALLOW_HEADERS,
+    max_age=CORS_MAX_AGE,
     supports_credentials=False,
 )
 
+# Mismas reglas que Flask-CORS: "*" permite todo, las entradas con caracteres de regex
+# se tratan como patrón y el resto se compara sin distinguir mayúsculas
+_REGEX_CHARS = frozenset("*\\]?$^[()")
+_ALLOW_ANY_ORIGIN = "*" in ALLOWED_ORIGINS
+_ALLOWED_ORIGINS_SET = frozenset(o.lower() for o in ALLOWED_ORIGINS if not _REGEX_CHARS.intersection(o))
+_ALLOWED_ORIGIN_PATTERNS = tuple(
+    re.compile(o, re.I) for o in ALLOWED_ORIGINS if o != "*" and _REGEX_CHARS.intersection(o)
+)
+
+def origin_allowed(origin: str | None) -> bool:
+    if not origin:
+        return False
+    if _ALLOW_ANY_ORIGIN or origin.lower() in _ALLOWED_ORIGINS_SET:
+        return True
+    return any(p.match(origin) for p in _ALLOWED_ORIGIN_PATTERNS)
+
+_PREFLIGHT_HEADERS = {
+    "Access-Control-Allow-Headers": ", ".join(CORS_ALLOW_HEADERS),
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+    "Access-Control-Max-Age": str(CORS_MAX_AGE),
+    "Vary": "Origin",
+}
+
 # === Storage del destino (URL del túnel) ===
 TARGET_KEY = "current_tunnel_url"
-_mem = {"url": None}
-rds = redis.from_url(REDIS_URL, decode_responses=True) if (REDIS_URL and redis) else None
+_mem = {"url": None, "upstream": None}
+# Pool persistente; respuestas en bytes: el destino se decodifica una sola vez al refrescar la caché
+rds = (
+    redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=32))
+    if (REDIS_URL and redis) else None
+)
+
+# Caché local del destino: evita un GET a Redis en cada request proxeado
+_cache = {"url": None, "upstream": None, "expiry": 0.0}
+
+def _upstream_url(url: str | None) -> str | None:
+    # URL completa del webhook, calculada una vez por destino y no por request
+    return f"{url.rstrip('/')}/webhook/optimus" if url else None
 
 def set_target(url: str):
     if rds:
         rds.set(TARGET_KEY, url)
     else:
-        _mem["url"] = url
+        _mem["url"], _mem["upstream"] = url, _upstream_url(url)
+    _cache["expiry"] = 0.0  # invalida la caché de este worker
+
+def _load_target() -> dict:
+    if not rds:
+        return _mem
+    now = time.monotonic()
+    if now < _cache["expiry"]:
+        return _cache
+    raw = rds.get(TARGET_KEY)
+    url = raw.decode() if raw is not None else None
+    _cache["url"], _cache["upstream"], _cache["expiry"] = url, _upstream_url(url), now + TARGET_CACHE_TTL
+    return _cache
 
 def get_target() -> str | None:
-    if rds:
-        return rds.get(TARGET_KEY)
-    return _mem.get("url")
+    return _load_target()["url"]
+
+def get_upstream_url() -> str | None:
+    return _load_target()["upstream"]
+
+# === Cliente HTTP hacia el backend ===
+# Cliente compartido: reutiliza conexiones keep-alive (evita TCP+TLS por request)
+# y multiplexa sobre HTTP/2 cuando el túnel lo soporta
+# TCP_NODELAY: sin Nagle, los JSON pequeños no esperan hasta 40 ms en el socket
+CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        # max_connections = --worker-connections de render.yaml: cada request en vuelo
+        # tiene su conexión y nadie espera (ni da PoolTimeout) por un hueco del pool
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=32),
+        socket_options=[
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ],
+    ),
+    # 120 s por operación (conexión, cada lectura, escritura, espera del pool), no total:
+    # no hay límite total por request (gunicorn -t tampoco lo es con gevent).
+    # Si tu IA tarda, puedes subir el timeout
+    timeout=httpx.Timeout(120.0),
+)
+STREAM_CHUNK_SIZE = 64 * 1024
+# No pasamos estos hop-by-hop ni la clave pública al backend (claves del environ WSGI)
+_SKIP_ENVIRON_HEADERS = frozenset((
+    "HTTP_HOST", "HTTP_CONTENT_LENGTH", "HTTP_CONTENT_TYPE", "HTTP_CONTENT_ENCODING",
+    "HTTP_TRANSFER_ENCODING", "HTTP_CONNECTION", "HTTP_KEEP_ALIVE", "HTTP_PROXY_CONNECTION",
+    "HTTP_TE", "HTTP_UPGRADE", CLIENT_KEY_ENVIRON,
+))
+
+# === Caché de respuestas (opcional, OPTIMUS_CACHE_TTL) ===
+# LRU con expiración por worker: (destino, headers reenviados, hash del cuerpo) -> (status, content-type, cuerpo).
+# Los headers van en la clave para no servir a un cliente la respuesta obtenida con las credenciales de otro
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _response_cache_get(key):
+    with _response_cache_lock:
+        item = _response_cache.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return item[1]
+
+def _response_cache_put(key, entry):
+    with _response_cache_lock:
+        _response_cache[key] = (time.monotonic() + OPTIMUS_CACHE_TTL, entry)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > OPTIMUS_CACHE_MAX:
+            _response_cache.popitem(last=False)
 
-TRYCLOUD_PAT = re.compile(r"^https://[a-z0-9-]+\.trycloudflare\.com$", re.I)  # opcional
+@functools.cache
+def _trycloud_re():
+    # opcional: solo se compila si se activa la validación en /admin/register
+    return re.compile(r"^https://[a-z0-9-]+\.trycloudflare\.com$", re.I)
+
+def is_admin() -> bool:
+    if not ADMIN_TOKEN:
+        return True
+    token = request.headers.get("admin-token", "").encode()
+    return hmac.compare_digest(token, ADMIN_TOKEN_B)
 
 @app.get("/health")
 def health():
+    # Sin Redis: los healthchecks de Render llegan cada pocos segundos
+    return {"ok": True}, 200
+
+@app.get("/admin/status")
+def status():
+    if not is_admin():
+        return jsonify({"error": "unauthorized"}), 401
     return {"ok": True, "target": get_target()}, 200
 
 @app.post("/admin/register")
 def register():
     # Admin no expone CORS (no lo listamos arriba). Debe llamarse desde backend/Postman.
-    if ADMIN_TOKEN and request.headers.get("admin-token") != ADMIN_TOKEN:
+    if not is_admin():
         return jsonify({"error": "unauthorized"}), 401
 
     data = request.get_json(silent=True) or {}
@@ -80,56 +220,99 @@ def register():
     if not url.startswith("http"):
         return jsonify({"error": "invalid url"}), 400
     # Para obligar quick tunnel, descomenta:
-    # if not TRYCLOUD_PAT.match(url): return jsonify({"error":"url not allowed"}), 400
+    # if not _trycloud_re().match(url): return jsonify({"error":"url not allowed"}), 400
 
     set_target(url)
     return {"ok": True, "target": url}, 200
 
+@app.after_request
+def webhook_cors(resp):
+    # Como hacía Flask-CORS: también decora los 500 de excepciones no controladas
+    if request.endpoint == "proxy_optimus":
+        origin = request.environ.get("HTTP_ORIGIN")
+        if origin_allowed(origin):
+            resp.headers["Access-Control-Allow-Origin"] = origin
+            resp.headers["Vary"] = "Origin"
+    return resp
+
 @app.route("/webhook/optimus", methods=["POST", "OPTIONS"])
 def proxy_optimus():
-    # Preflight CORS (OPTIONS)
+    # Preflight CORS (OPTIONS); Access-Control-Allow-Origin lo añade webhook_cors
     if request.method == "OPTIONS":
-        return ("", 204)
+        if not origin_allowed(request.environ.get("HTTP_ORIGIN")):
+            return ("", 204)
+        return Response("", 204, _PREFLIGHT_HEADERS)
 
     # Auth cliente → Render (opcional pero recomendado)
-    if CLIENT_API_KEY and request.headers.get("x-client-key") != CLIENT_API_KEY:
+    if CLIENT_API_KEY and request.environ.get(CLIENT_KEY_ENVIRON) != CLIENT_API_KEY:
         return jsonify({"error": "forbidden"}), 403
 
-    upstream_base = get_target()
-    if not upstream_base:
+    upstream_url = get_upstream_url()
+    if not upstream_url:
         return jsonify({"error": "no upstream registered"}), 503
 
-    upstream_url = f"{upstream_base}/webhook/optimus"
-
     # ✨ SUMA: reenviar headers útiles tal cual, + añadir x-api-key para el backend
     forward_headers = {}
-    for k, v in request.headers.items():
-        lk = k.lower()
-        # No pasamos estos hop-by-hop ni la clave pública al backend
-        if lk in ("host", "content-length", "content-encoding", "transfer-encoding", "connection"):
-            continue
-        if lk == "x-client-key":
-            continue
-        forward_headers[k] = v
+    for k, v in request.environ.items():
+        if k.startswith("HTTP_") and k not in _SKIP_ENVIRON_HEADERS:
+            # WSGI entrega los valores como latin-1: se reenvían los bytes originales
+            # (httpx codifica los str como ASCII y fallaría con valores UTF-8)
+            forward_headers[k[5:].replace("_", "-").title()] = v.encode("latin-1")
     # Forzamos Content-Type si no viene y añadimos la firma interna
-    forward_headers["Content-Type"] = request.headers.get("Content-Type", "application/json")
+    forward_headers["Content-Type"] = (request.environ.get("CONTENT_TYPE") or "application/json").encode("latin-1")
     forward_headers["x-api-key"] = UPSTREAM_API_KEY
 
     if DEBUG_HEADERS:
         try:
-            print(">> proxy → backend headers:", json.dumps({k: forward_headers[k] for k in sorted(forward_headers)}, ensure_ascii=False))
+            print(">> proxy → backend headers:", json.dumps({k: forward_headers[k].decode("latin-1") if isinstance(forward_headers[k], bytes) else forward_headers[k] for k in sorted(forward_headers)}, ensure_ascii=False))
         except Exception:
             pass
 
-    # reenviamos el JSON tal cual llega
-    raw = request.get_data()
-    try:
-        # si tu IA tarda, puedes subir el timeout
-        resp = requests.post(upstream_url, data=raw, headers=forward_headers, timeout=120)
-        return Response(
-            resp.content,
-            status=resp.status_code,
-            content_type=resp.headers.get("Content-Type", "application/json"),
+    cache_key = None
+    if OPTIMUS_CACHE_TTL > 0:
+        # con caché activa hace falta el cuerpo completo para calcular la clave
+        body = request.get_data(cache=False)
+        cache_key = (
+            upstream_url,
+            tuple(sorted(forward_headers.items())),
+            hashlib.blake2b(body, digest_size=16).digest(),
         )
+        hit = _response_cache_get(cache_key)
+        if hit is not None:
+            status, content_type, content = hit
+            return Response(content, status=status, content_type=content_type)
+        forward_headers["Content-Length"] = str(len(body))
+    else:
+        # reenviamos el cuerpo tal cual llega, en streaming (sin cargarlo en memoria);
+        # con Content-Length conocido httpx no usa chunked
+        if request.content_length is not None:
+            forward_headers["Content-Length"] = str(request.content_length)
+        body = iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b"")
+    try:
+        upstream_req = CLIENT.build_request("POST", upstream_url, content=body, headers=forward_headers)
+        resp = CLIENT.send(upstream_req, stream=cache_key is None)
+    except httpx.TimeoutException as e:
+        return jsonify({"error": f"upstream timeout: {str(e)}"}), 504
+    except (httpx.RequestError, httpx.InvalidURL) as e:
+        return jsonify({"error": f"upstream error: {str(e)}"}), 502
     except Exception as e:
         return jsonify({"error": f"upstream error: {str(e)}"}), 502
+
+    if cache_key is not None:
+        content_type = resp.headers.get("Content-Type", "application/json")
+        if resp.status_code == 200:
+            _response_cache_put(cache_key, (resp.status_code, content_type, resp.content))
+        return Response(resp.content, status=resp.status_code, content_type=content_type)
+
+    # iter_bytes descomprime, así que Content-Length solo vale si no hay Content-Encoding
+    response_headers = {}
+    if "Content-Length" in resp.headers and "Content-Encoding" not in resp.headers:
+        response_headers["Content-Length"] = resp.headers["Content-Length"]
+    out = Response(
+        resp.iter_bytes(STREAM_CHUNK_SIZE),
+        status=resp.status_code,
+        headers=response_headers,
+        content_type=resp.headers.get("Content-Type", "application/json"),
+    )
+    out.call_on_close(resp.close)
+    return out